@@ -0,0 +1,45 @@
+""" Measures the cold import time of lineart_v3 and checks it against a budget.
+
+    python benchmarks/import_time.py [budget_in_seconds]
+
+Each run imports the module in a fresh interpreter. The check fails if the
+fastest run is over the budget or if a heavy backend was loaded at import.
+"""
+import os
+import subprocess
+import sys
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Backends that should only be loaded on first use.
+heavy_modules = ["pygame", "cv2", "sympy", "plotly", "pandas", "matplotlib", 
+                 "moviepy", "IPython", "PIL"]
+
+probe = """
+import sys, time
+start = time.perf_counter()
+import lineart_v3
+elapsed = time.perf_counter() - start
+loaded = [name for name in %r if name in sys.modules]
+print(elapsed, ",".join(loaded))
+""" % (heavy_modules,)
+
+def import_time(runs=5):
+  """ returns the fastest import time and the heavy modules that were loaded. """
+  times = []
+  for run in range(runs):
+    out = subprocess.run([sys.executable, "-c", probe], cwd=repo_dir, 
+                         capture_output=True, text=True, check=True).stdout.split()
+    times.append(float(out[0]))
+    loaded = out[1].split(",") if len(out) > 1 else []
+  return min(times), loaded
+
+if __name__ == "__main__":
+  budget = float(sys.argv[1]) if len(sys.argv) > 1 else 0.5
+  elapsed, loaded = import_time()
+  print(f"import lineart_v3: {elapsed*1000:.1f} ms (budget {budget*1000:.0f} ms)")
+
+  if loaded:
+    print("Heavy modules loaded at import: ", ", ".join(loaded))
+  if elapsed > budget or loaded:
+    sys.exit(1)
@@ -0,0 +1,45 @@
+""" Measures the cost of drawing one race frame against the number of characters.
+
+    python benchmarks/race_scaling.py [frames]
+
+Each race uses lanes=True and is drawn headless. The frames are not encoded,
+so the times are for the simulation and the compositing only.
+"""
+import os
+import sys
+import time
+import types
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import lineart_v3
+
+images = ["Bowser.jpg", "Tortoise.jpg", "Koala.jpeg", "Squirrel.jpeg", "Elephant.jpeg"]
+character_counts = [1, 3, 10, 30, 100, 200]
+
+class nullWriter:
+  """ A video writer that drops the frames. """
+  def write(self, frame):
+    pass
+
+def frame_time(num_chars, frames):
+  """ returns the seconds per frame for a race with num_chars characters. """
+  tables = [types.SimpleNamespace(name=f"Racer {idx}", img=os.path.join(repo_dir, images[idx % len(images)]),
+                                  loc=(0, 0), speed=5 + idx % 20)
+            for idx in range(num_chars)]
+  race = lineart_v3.simulationVideo(tables, 10, 100, "Race")
+  race.set_video(fps=frames / 10, vid_height=1080, headless=True, lanes=True)
+
+  vid_disp = race.create_display()
+  start = time.perf_counter()
+  race.render_frames(vid_disp, nullWriter(), 0, frames)
+  return (time.perf_counter() - start) / frames
+
+if __name__ == "__main__":
+  frames = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+  print("characters   ms/frame   us/character")
+  for num_chars in character_counts:
+    seconds = frame_time(num_chars, frames)
+    print(f"{num_chars:10d} {seconds*1000:10.2f} {seconds*1e6/num_chars:14.1f}")
@@ -3,10 +3,13 @@ from __future__ import print_function
 # Interactive visualization command in Jupyter Lab
 # !pip install ipywidgets
 
+import copy
+import functools
+import hashlib
+import importlib
+from collections import OrderedDict
 from io import BytesIO
-from PIL import Image
 
-import cv2
 import os
 
 # from ipywidgets import interact, interactive, fixed, interact_manual, FloatSlider
@@ -16,33 +19,272 @@ import numpy as np              # import NumPy library
 
 import numbers
 
+class lazyModule:
+  """ 
+  Stands in for a module that is imported on first attribute access.
+  Heavy backends (pygame, OpenCV, SymPy, plotly, moviepy, ...) are only loaded
+  when a function needs them, so importing this file stays fast.
+  """
+
+  def __init__(self, name):
+    self._name   = name
+    self._module = None
+
+  def __getattr__(self, attr):
+    if self._module is None:
+      self._module = importlib.import_module(self._name)
+    return getattr(self._module, attr)
+
+  def __repr__(self):
+    state = "loaded" if self._module is not None else "not loaded"
+    return f"<lazy module '{self._name}' ({state})>"
+
+Image = lazyModule("PIL.Image")
+cv2   = lazyModule("cv2")
+
 # Plot the function:
-import matplotlib.pyplot as plt
+plt = lazyModule("matplotlib.pyplot")
 
 # import math # for floor and ceiling
-import sympy as sp
-x = sp.symbols('x')
+sp = lazyModule("sympy")
+
+# Compiled NumPy callables for showTable(), keyed by the SymPy expression.
+_compiled_functions = {}
 
-import pygame
+pygame = lazyModule("pygame")
 import sys
 import time
 
+# Parallel rendering and stitching of video segments
+import math
+import shutil
+import subprocess
+import tempfile
+import types
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Streaming frames to ffmpeg
+import queue
+import threading
+
 # Import plotly
 # !pip install kaleido
 
 # import plotly
-import plotly.graph_objects as go
-import plotly.express as px
+go = lazyModule("plotly.graph_objects")
+px = lazyModule("plotly.express")
 
 # Data frames using pandas
-import pandas as pd
+pd = lazyModule("pandas")
 
-from IPython.display import HTML
 from base64 import b64encode
 
 # Import functions and library
-import moviepy.editor
-from moviepy.editor import VideoFileClip, vfx
+moviepy_editor = lazyModule("moviepy.editor")
+
+def __getattr__(name):
+  """ module attributes that need a heavy backend are created on first use. """
+  if name == "x":
+    return sp.symbols('x')
+  if name in ("VideoFileClip", "vfx"):
+    return getattr(moviepy_editor, name)
+  if name == "HTML":
+    return importlib.import_module("IPython.display").HTML
+  raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+@functools.lru_cache(maxsize=None)
+def ffmpegBinary():
+  """ returns the ffmpeg executable: the one on the PATH or the one used by moviepy.
+      It is looked up once per process.
+  """
+  ffmpeg = shutil.which("ffmpeg")
+  if ffmpeg is None:
+    from moviepy.config import get_setting
+    ffmpeg = get_setting("FFMPEG_BINARY")
+  return ffmpeg
+
+class FFmpegWriter:
+  """
+  A video writer that pipes frames to an ffmpeg process.
+  The frames are encoded directly with the given ffmpeg codec (e.g. "libx264").
+  It can be used in place of cv2.VideoWriter.
+
+  Frames are copied into a bounded queue and sent to ffmpeg by a writer thread,
+  so rendering and encoding run at the same time.
+  queue_size limits the number of frames waiting to be encoded.
+
+  codec="mjpeg" encodes each frame to JPEG with OpenCV and ffmpeg only stores 
+  the packets. hold() then encodes a still frame once for the whole stretch.
+
+  input_size is the (width, height) of the frames given to write(), if it
+  differs from frame_size. The writer thread then scales them with fitFrame().
+  """
+
+  def __init__(self, video_name, fps, frame_size, codec="libx264", 
+               pix_fmt="yuv420p", queue_size=8, jpeg_quality=95, input_size=None):
+    self.video_name = video_name
+    self.frame_size = tuple(int(size) for size in frame_size)
+    self.input_size = self.frame_size if input_size is None else tuple(int(size) for size in input_size)
+    self.codec = codec
+    self.jpeg_quality = jpeg_quality
+    self.error = None
+
+    width, height = self.frame_size
+    if codec == "mjpeg":
+      # JPEG packets are copied into the container.
+      input_args  = ["-f", "mjpeg", "-framerate", str(fps)]
+      output_args = ["-c:v", "copy"]
+    else:
+      input_args  = ["-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", str(fps)]
+      output_args = ["-c:v", codec, "-pix_fmt", pix_fmt]
+    cmd = [ffmpegBinary(), "-y", "-loglevel", "error"] + input_args + \
+          ["-i", "pipe:0", "-an"] + output_args + [video_name]
+    self.stderr = tempfile.TemporaryFile()
+    self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=self.stderr)
+
+    self.frames = queue.Queue(maxsize=queue_size)
+    self.thread = threading.Thread(target=self._send_frames, daemon=True)
+    self.thread.start()
+
+  def _send_frames(self):
+    """ writer thread: sends queued frames to ffmpeg until it gets None. """
+    while True:
+      item = self.frames.get()
+      if item is None:
+        break
+      if self.error is None:
+        frame, count = item
+        try:
+          if self.input_size != self.frame_size:
+            frame = fitFrame(frame, self.frame_size)
+          if self.codec == "mjpeg":
+            frame = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])[1]
+          # The same encoded or raw frame is sent for every repeat.
+          data = memoryview(frame).cast("B")
+          for i in range(count):
+            self.proc.stdin.write(data)
+        except (BrokenPipeError, OSError) as err:
+          self.error = err
+
+  def isOpened(self):
+    return self.proc.poll() is None and self.error is None
+
+  def write(self, frame):
+    """ queues a copy of frame (height x width x 3, uint8, BGR). """
+    self.hold(frame, 1)
+
+  def hold(self, frame, count):
+    """ queues frame to be shown count times. The frame is copied once. """
+    if self.error is not None:
+      # ffmpeg has stopped: clean up and raise with its error message.
+      self.release()
+      raise RuntimeError("Error: ffmpeg stopped while writing " + self.video_name)
+    if (frame.shape[1], frame.shape[0]) != self.input_size:
+      raise ValueError("Frame size does not match the video size")
+    if count > 0:
+      self.frames.put((np.array(frame, dtype=np.uint8, order="C"), int(count)))
+
+  def release(self):
+    """ waits for the queued frames to be encoded and closes the video file. """
+    if self.proc.stdin.closed:
+      return
+    self.frames.put(None)
+    self.thread.join()
+    try:
+      self.proc.stdin.close()
+    except (BrokenPipeError, OSError) as err:
+      self.error = self.error or err
+    returncode = self.proc.wait()
+
+    self.stderr.seek(0)
+    message = self.stderr.read().decode(errors="replace")
+    self.stderr.close()
+    if returncode != 0 or self.error is not None:
+      raise RuntimeError("Error: ffmpeg failed to encode " + self.video_name + "\n" + message)
+
+def holdFrame(video, frame, count):
+  """ writes frame count times to video. Writers with a hold() method
+      (FFmpegWriter) encode the still stretch once, or as cheaply as the codec allows.
+  """
+  if hasattr(video, "hold"):
+    video.hold(frame, count)
+  else:
+    for i in range(count):
+      video.write(frame)
+
+def fitFrame(frame, frame_size):
+  """ returns frame scaled to frame_size = (width, height) with area resampling.
+      If the aspect ratio differs, the scaled frame is centered on white, 
+      so the layout of the frame is kept.
+  """
+  width, height = frame_size
+  old_h, old_w  = frame.shape[:2]
+  scale = min(width / old_w, height / old_h)
+  new_w = min(width,  max(1, round(old_w * scale)))
+  new_h = min(height, max(1, round(old_h * scale)))
+  scaled = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_AREA)
+  if (new_w, new_h) == (width, height):
+    return scaled
+
+  pad_h_t, pad_h_b, pad_w_l, pad_w_r = paddingSizes(new_h, new_w, height, width)
+  return cv2.copyMakeBorder(scaled, pad_h_t, pad_h_b, pad_w_l, pad_w_r,
+                            cv2.BORDER_CONSTANT, None, value = [255, 255, 255])
+
+class scaledWriter:
+  """ Scales frames to frame_size with fitFrame() before writing them to writer. """
+
+  def __init__(self, writer, frame_size):
+    self.writer = writer
+    self.frame_size = tuple(frame_size)
+
+  def isOpened(self):
+    return self.writer.isOpened()
+
+  def write(self, frame):
+    self.writer.write(fitFrame(frame, self.frame_size))
+
+  def hold(self, frame, count):
+    holdFrame(self.writer, fitFrame(frame, self.frame_size), count)
+
+  def release(self):
+    self.writer.release()
+
+def openVideoWriter(video_name, fps, frame_size, codec=None, input_size=None):
+  """ opens a video writer for frames of frame_size = (width, height).
+      codec=None writes MJPG with OpenCV. Otherwise, the frames are piped to
+      ffmpeg and encoded with the given ffmpeg codec (e.g. "libx264").
+      codec="mjpeg" gives MJPG with cheap still frames (see FFmpegWriter).
+      input_size is the size of the frames that will be written, if they
+      have to be scaled to frame_size first.
+  """
+  frame_size = (int(frame_size[0]), int(frame_size[1]))
+  scale = input_size is not None and tuple(input_size) != frame_size
+  if codec is None:
+    writer = cv2.VideoWriter(video_name, cv2.VideoWriter_fourcc(*'MJPG'), fps, frame_size)
+    return scaledWriter(writer, frame_size) if scale else writer
+  else:
+    return FFmpegWriter(video_name, fps, frame_size, codec, input_size=input_size)
+
+def concatVideos(video_name, file_list):
+  """ concatenates videos with the same codec, size and frame rate into video_name.
+      The video packets are copied: nothing is decoded or re-encoded.
+      Only the video is kept, like the videos written by openVideoWriter().
+  """
+  list_fd, list_name = tempfile.mkstemp(suffix=".txt")
+  with os.fdopen(list_fd, "w") as list_file:
+    for filename in file_list:
+      list_file.write("file '" + os.path.abspath(filename).replace("'", "'\\''") + "'\n")
+
+  try:
+    cmd = [ffmpegBinary(), "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", 
+           "-i", list_name, "-map", "0:v", "-c", "copy", video_name]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+  finally:
+    os.remove(list_name)
+
+  if result.returncode != 0:
+    raise RuntimeError("Error: ffmpeg could not concatenate the videos.\n" + result.stderr)
 
 class table():
   def __init__(self, 
@@ -106,17 +348,14 @@ class table():
     """ creates a Table from a function and its domain, and it saves it to img_name.
     """
     # Generate the x-values and y-values
-    x = sp.symbols('x')
-    y_values = []
     x_values = np.linspace(*domain) # Unpack the list of elements.
-    for val in x_values:
-      y_values.append(float(fun.subs(x, val)))
+    y_values = compileFunction(fun)(x_values)
 
     # Create the labels:
     self.column_labels = ["x", "y="+str(fun)]
     
     # Data
-    self.data_values = [x_values.tolist(), y_values]
+    self.data_values = [x_values.tolist(), y_values.tolist()]
     
     # Plot the table
     self.plotTable()
@@ -167,6 +406,24 @@ class table():
       # Update the figure:
       self.fig.show()
   
+def compileFunction(fun):
+  """ returns a NumPy-vectorized callable for the SymPy expression fun(x).
+      Compiled callables are cached, so the same expression is compiled once.
+  """
+  fun = sp.sympify(fun)
+  if fun not in _compiled_functions:
+    numpy_fun = sp.lambdify(sp.symbols('x'), fun, modules="numpy")
+
+    def vectorized_fun(x_values):
+      # Constant expressions return a scalar: broadcast it to the domain.
+      x_values = np.asarray(x_values, dtype=float)
+      y_values = np.asarray(numpy_fun(x_values), dtype=float)
+      return np.broadcast_to(y_values, x_values.shape).copy()
+
+    _compiled_functions[fun] = vectorized_fun
+
+  return _compiled_functions[fun]
+
 def plotTablesLines(tables = None, 
                     fig_title = None, x_label = None, y_label = None, 
                     legend_title = None, legend_labels = None,
@@ -269,6 +526,243 @@ def plotTablesLines(tables = None,
       cv2.imwrite(img_name, bgr_img) 
       # tmp.saveImage(img_name)
 
+class textCache:
+  """
+  Caches rendered text surfaces for a pygame font.
+  Static labels are rendered once. Numeric readouts such as
+  "Distance: 12.34 miles" are assembled from cached label and digit glyphs.
+  """
+
+  def __init__(self, font, color=(0, 0, 0)):
+    self.font  = font
+    self.color = color
+    self.labels = {}  # text -> (surface, advance)
+    self.glyphs = {}  # character -> (surface, advance)
+    # Bounds for readout rectangles: the tallest surface and the most 
+    # that a surface reaches past its advance.
+    self.height   = 0
+    self.overhang = 0
+
+  def _lookup(self, cache, text):
+    if text not in cache:
+      surface = self.font.render(text, True, self.color)
+      advance = self.font.size(text)[0]
+      self.height   = max(self.height, surface.get_height())
+      self.overhang = max(self.overhang, surface.get_width() - advance)
+      cache[text] = (surface, advance)
+    return cache[text]
+
+  def render(self, text):
+    """ returns the cached surface for a static label. """
+    return self._lookup(self.labels, text)[0]
+
+  def blit_label(self, surface, text, topleft):
+    """ draws a static label and returns the rectangle that was drawn. """
+    label = self.render(text)
+    return surface.blit(label, topleft)
+
+  def readout_blits(self, prefix, value, suffix, topleft):
+    """ returns the (surface, position) pairs that draw prefix + f"{value:.2f}" + suffix,
+        for Surface.blits(), and the rectangle that they cover.
+    """
+    x, y = topleft
+    label, advance = self._lookup(self.labels, prefix)
+    blit_list = [(label, (x, y))]
+    x += advance
+
+    glyphs = self.glyphs
+    for char in f"{value:.2f}":
+      glyph, advance = glyphs[char] if char in glyphs else self._lookup(glyphs, char)
+      blit_list.append((glyph, (x, y)))
+      x += advance
+
+    label, advance = self._lookup(self.labels, suffix)
+    blit_list.append((label, (x, y)))
+    x += advance
+    # The rectangle may be a little larger than what is drawn.
+    return blit_list, pygame.Rect(topleft[0], y, x - topleft[0] + self.overhang, self.height)
+
+  def blit_readout(self, surface, prefix, value, suffix, topleft):
+    """ draws prefix + f"{value:.2f}" + suffix and returns the rectangle that was drawn.
+    """
+    blit_list, rect = self.readout_blits(prefix, value, suffix, topleft)
+    surface.blits(blit_list, doreturn=False)
+    return rect
+
+
+# Fonts and text caches shared by every race rendered in this process.
+_fonts       = {}
+_text_caches = {}
+
+def raceTextCache(font_size, color=(0, 0, 0)):
+  """ returns a shared text cache for the default pygame font of font_size. """
+  if not pygame.font.get_init():
+    pygame.font.init()
+
+  if font_size not in _fonts:
+    _fonts[font_size] = pygame.font.Font(None, font_size)
+  if (font_size, color) not in _text_caches:
+    _text_caches[(font_size, color)] = textCache(_fonts[font_size], color)
+  return _text_caches[(font_size, color)]
+
+def quitPygame():
+  """ closes pygame and drops the cached fonts, which do not survive pygame.quit(). """
+  _text_caches.clear()
+  _fonts.clear()
+  pygame.quit()
+
+class spriteCache:
+  """
+  A process-wide cache of character images scaled to a target width.
+  Sprites are keyed by (path, file modification time, target_width), so an
+  edited image is loaded again. The least recently used sprites are dropped
+  once the cached pixels take more than max_bytes.
+
+  save_pack() writes the cached sprites to an .npz file. load_pack() reads it
+  in another process, so the JPEG/PNG files do not have to be decoded again.
+  """
+
+  def __init__(self, max_bytes=256*1024*1024):
+    self.max_bytes = max_bytes
+    self.nbytes    = 0
+    self.sprites   = OrderedDict()  # key -> scaled pygame surface
+    self.packed    = {}             # key -> (pixels, format) read from a sprite pack
+
+  def key(self, img_path, target_width):
+    """ returns the cache key for an image file. """
+    img_path = os.path.abspath(img_path)
+    try:
+      mtime = os.stat(img_path).st_mtime_ns
+    except OSError:
+      mtime = None
+    return (img_path, mtime, target_width)
+
+  def get(self, img_path, target_width):
+    """ returns the image img_path scaled to target_width pixels wide. """
+    key = self.key(img_path, target_width)
+    if key in self.sprites:
+      self.sprites.move_to_end(key)
+      return self.sprites[key]
+
+    if key in self.packed:
+      pixels, pixel_format = self.packed[key]
+      py_img = pygame.image.frombytes(pixels.tobytes(), (pixels.shape[1], pixels.shape[0]), pixel_format)
+    else:
+      # load the given character image:
+      py_img = pygame.image.load(img_path)
+
+      # Get the size of the image
+      width, height = py_img.get_size()
+
+      # Transform the width to target_width pixels
+      # height/new = width/target_width
+      height_size = target_width * (height/width)
+      py_img = pygame.transform.scale(py_img, (target_width, height_size))
+
+    self.sprites[key] = py_img
+    self.nbytes += py_img.get_pitch() * py_img.get_height()
+
+    # Drop the least recently used sprites
+    while self.nbytes > self.max_bytes and len(self.sprites) > 1:
+      old_key, old_img = self.sprites.popitem(last=False)
+      self.nbytes -= old_img.get_pitch() * old_img.get_height()
+    return py_img
+
+  def clear(self):
+    """ removes all cached and packed sprites. """
+    self.sprites.clear()
+    self.packed.clear()
+    self.nbytes = 0
+
+  def save_pack(self, pack_name):
+    """ saves the cached sprites, already scaled, to the .npz file pack_name. """
+    arrays = {}
+    keys   = []
+    for idx, (key, py_img) in enumerate(self.sprites.items()):
+      pixel_format = "RGBA" if py_img.get_flags() & pygame.SRCALPHA else "RGB"
+      pixels = np.frombuffer(pygame.image.tobytes(py_img, pixel_format), dtype=np.uint8)
+      arrays[f"sprite{idx}"] = pixels.reshape(py_img.get_height(), py_img.get_width(), len(pixel_format))
+      keys.append([key[0], str(key[1]), str(key[2]), pixel_format])
+    np.savez(pack_name, keys=np.array(keys, dtype=str).reshape(-1, 4), **arrays)
+    print("Wrote ", len(keys), " sprites to ", pack_name)
+
+  def load_pack(self, pack_name):
+    """ reads sprites saved by save_pack(). Sprites of images that changed are skipped. """
+    with np.load(pack_name) as pack:
+      for idx, (img_path, mtime, target_width, pixel_format) in enumerate(pack["keys"]):
+        key = (str(img_path), None if mtime == "None" else int(mtime), int(target_width))
+        if self.key(key[0], key[2]) == key:
+          self.packed[key] = (pack[f"sprite{idx}"], str(pixel_format))
+
+sprite_cache = spriteCache()
+
+def loadSprite(img_path, target_width):
+  """ returns the image img_path scaled to target_width pixels wide.
+      Scaled images are shared through sprite_cache, so each image is decoded once.
+  """
+  return sprite_cache.get(img_path, target_width)
+
+
+def speedProfile(tbl):
+  """ returns the breakpoints (times, distances) of a race character as arrays,
+      or None if the character runs at the constant speed tbl.speed.
+      Characters without a speed use tbl.data_values = [times, distances],
+      the layout of table.showTable(). Distances may not decrease.
+  """
+  if getattr(tbl, "speed", None) is not None:
+    return None
+
+  name = getattr(tbl, "name", "?")
+  data_values = getattr(tbl, "data_values", None)
+  if data_values is None or len(data_values) < 2:
+    raise ValueError(f'Character {name} has no speed. A speed profile needs at least '
+                     'two (time, distance) breakpoints in data_values')
+
+  times, distances = (np.asarray(values, dtype=float) for values in data_values[:2])
+  if times.ndim != 1 or times.shape != distances.shape or len(times) < 2:
+    raise ValueError(f'Character {name}: a speed profile needs at least two (time, distance) breakpoints')
+  if np.any(np.diff(times) <= 0):
+    raise ValueError(f'Character {name}: speed profile times should be increasing')
+  if np.any(np.diff(distances) < 0):
+    raise ValueError(f'Character {name}: speed profile distances should not decrease')
+  return times, distances
+
+def profileDistances(profile, clocks):
+  """ returns the distances of a speed profile at the race clocks.
+      The distance is interpolated between breakpoints. Before the first one
+      it is the first distance, after the last one the last speed continues.
+  """
+  times, distances = profile
+  values = np.interp(clocks, times, distances)
+  slope  = (distances[-1] - distances[-2]) / (times[-1] - times[-2])
+  return np.where(clocks > times[-1], distances[-1] + slope*(clocks - times[-1]), values)
+
+def profileFinishTime(profile, race_distance):
+  """ returns when a speed profile reaches race_distance (math.inf if never). """
+  times, distances = profile
+  idx = np.searchsorted(distances, race_distance, side="left")
+  if idx == 0:
+    return 0.0
+  if idx == len(distances):
+    slope = (distances[-1] - distances[-2]) / (times[-1] - times[-2])
+    if slope <= 0:
+      return math.inf
+    return times[-1] + (race_distance - distances[-1]) / slope
+
+  # Interpolate inside the breakpoint interval that reaches the distance.
+  t0, t1 = times[idx - 1], times[idx]
+  d0, d1 = distances[idx - 1], distances[idx]
+  return t0 + (race_distance - d0) * (t1 - t0) / (d1 - d0)
+
+def profileAverageSpeed(profile, race_distance):
+  """ returns the average speed of a speed profile over the race. """
+  times, distances = profile
+  finish_time = profileFinishTime(profile, race_distance)
+  if 0 < finish_time < math.inf:
+    return race_distance / finish_time
+  return (distances[-1] - distances[0]) / (times[-1] - times[0])
+
+
 class simulationVideo:
   """
   The race class is used for preparing a race video simulation.
@@ -285,6 +779,9 @@ class simulationVideo:
       table_name.img:   image filename that represents the character.
       table_name.loc:   Pixel coordinates for the setup (e.g., (0, 50))
       table_name.speed: the physical speed
+  or, for a speed that changes, table_name.speed=None and
+      table_name.data_values: [times, distances] breakpoints (see speedProfile).
+      The character is shown with its average speed.
 
   target_width:  the number of pixels for each character. Default=100 pixels.
 
@@ -313,15 +810,32 @@ class simulationVideo:
   target_width:     the target width for the downloaded character images.
   simulation_speed: simulation_speed gives the skip number of frames.
                     Default=1.0. If simulation_speed=2, the frame rate is halved.
+  headless:   if True, frames are drawn offscreen into a reused BGR buffer
+              that goes straight to the video writer. No display is needed.
+  codec:      None writes MJPG with OpenCV. An ffmpeg codec name (e.g. "libx264")
+              streams the frames to ffmpeg and encodes them directly.
+  lanes:      if True, the characters get equal lanes from top to bottom and 
+              table_name.loc[1] is not used. Images are shrunk to fit their lane, 
+              and the panel shows one line per character: name, distance and time.
+              Use it for races with many characters.
+
+  Results only (optional)
+  -----------------------
+  render:     if False, pygame is not started and no images are loaded.
+              Use results() for the race outcome. create_video() is not available.
   """
 
-  def __init__(self, tables, duration, race_distance, vid_title):
+  def __init__(self, tables, duration, race_distance, vid_title, render=True):
     """ Setup the simulation basic parameters.
     """
     self.tables   = tables
     self.duration = duration 
     self.race_distance = race_distance
     self.vid_title     = vid_title 
+    self.render   = render
+
+    # Extra video outputs (see set_outputs)
+    self.outputs = []
 
     # Call functions to set default values:
     self.set_units()
@@ -331,30 +845,30 @@ class simulationVideo:
   def resize_characters(self, py_imgs, py_rects, py_rect_speed, orig_speeds, coords, img_names):
     """ helper function for resizing character images and storing them locally. """
 
-    for tbl in self.tables:
-        # load the given character image:
-        py_img = pygame.image.load(tbl.img)
-
-        # Get the size of the image
-        image_size = py_img.get_size()
-        width  = image_size[0]
-        height = image_size[1]
-
-        # Transform the width to 100 pixels
-        # height/new = width/target_width
+    for lane, tbl in enumerate(self.tables):
+        # load the given character image resized to target_width pixels:
         img_name = tbl.name 
-        height_size = self.target_width * (height/width)
-        img_size   = (self.target_width, height_size)
-        py_img = pygame.transform.scale(py_img, img_size)
+        py_img = loadSprite(tbl.img, self.target_width)
+        loc = tbl.loc
+
+        if self.lanes:
+          # Place the character in its lane, shrunk to the lane height.
+          lane_y = int(self.lane_top + lane*self.lane_height)
+          if py_img.get_height() > int(self.lane_height):
+            width = max(1, int(self.target_width * int(self.lane_height) / py_img.get_height()))
+            py_img = loadSprite(tbl.img, width)
+          # The track assumes target_width wide images: keep the right edge 
+          # where it would be, so characters start and finish on the lines.
+          loc = (tbl.loc[0] + self.target_width - py_img.get_width(), lane_y)
 
         # Check if it fits or not.
-        loc0_ok = (tbl.loc[0] >= 0) and (tbl.loc[0] + py_img.get_width() <= self.vid_width)
-        loc1_ok = (tbl.loc[1] + py_img.get_height() <= self.vid_height) and (tbl.loc[1] >= 0)
+        loc0_ok = (loc[0] >= 0) and (loc[0] + py_img.get_width() <= self.vid_width)
+        loc1_ok = (loc[1] + py_img.get_height() <= self.vid_height) and (loc[1] >= 0)
         if (loc0_ok and loc1_ok):
-          py_rect = pygame.Rect(tbl.loc[0], tbl.loc[1], py_img.get_width(), py_img.get_height())
+          py_rect = pygame.Rect(loc[0], loc[1], py_img.get_width(), py_img.get_height())
         else:
           print("ERROR in placing an image in the video!")
-          print("Table loc [0] = ", tbl.loc[0], ", Table loc [1] = ", tbl.loc[1])
+          print("Table loc [0] = ", loc[0], ", Table loc [1] = ", loc[1])
           print("Resized image width = ", py_img.get_width(), ", Resized image height = ", py_img.get_height())
           print("Number of rows in the video = ", self.vid_height)
           print("Number of columns in the video = ", self.vid_width)
@@ -362,10 +876,11 @@ class simulationVideo:
          
         py_imgs.append(py_img)
         py_rects.append(py_rect)
-        py_rect_speed.append(tbl.speed)
-        orig_speeds.append(tbl.speed)
-        coords.append([tbl.loc[0], tbl.loc[1]])
+        py_rect_speed.append(getattr(tbl, "speed", None))
+        orig_speeds.append(getattr(tbl, "speed", None))
+        coords.append([loc[0], loc[1]])
         img_names.append(img_name)
+        self.profiles.append(speedProfile(tbl))
   
   
 
@@ -378,7 +893,8 @@ class simulationVideo:
 
 
   def set_video(self, video_name="race.mp4", fps=30, vid_width=800, vid_height=600, 
-                max_frames=10000, target_width=100, simulation_speed=1.0):
+                max_frames=10000, target_width=100, simulation_speed=1.0,
+                headless=False, codec=None, lanes=False):
     """ Setup the video simulation parameters. Default values are provided.
     """
     # Video dimension check
@@ -393,7 +909,8 @@ class simulationVideo:
     
     # pygame.display.set_caption('Race to Bumpers') # Enable this to run locally    
     # Initialize pygame 
-    pygame.init()
+    if self.render:
+      pygame.init()
     
     # Setup the video  
     self.video_name = video_name
@@ -404,6 +921,9 @@ class simulationVideo:
 
     self.target_width  = target_width
     self.simulation_speed = simulation_speed
+    self.headless = headless
+    self.codec = codec
+    self.lanes = lanes
     
     # Setup some default scales:
     self.end_line_scale = 0.3         # Between 0 and 1.
@@ -424,8 +944,13 @@ class simulationVideo:
     # Black color
     self.black = (0, 0, 0)
 
+    # Lanes between the title and the axis line
+    self.lane_top = 40
+    self.lane_height = (self.axis_line - self.lane_top) / max(len(self.tables), 1)
+
     # Video character font size
-    self.vid_disp_font = pygame.font.Font(None, self.disp_font_sz)
+    if self.render:
+      self.load_text_caches()
     
     # Extract table objects attributes
     self.py_imgs   = []
@@ -434,8 +959,18 @@ class simulationVideo:
     self.orig_speeds = []
     self.coords    = []
     self.img_names = []
-    self.resize_characters(self.py_imgs, self.py_rects, self.py_rect_speed, 
-                           self.orig_speeds, self.coords, self.img_names)
+    self.profiles  = []
+    if self.render:
+      self.resize_characters(self.py_imgs, self.py_rects, self.py_rect_speed, 
+                             self.orig_speeds, self.coords, self.img_names)
+    else:
+      # Results only: the images are not needed.
+      for tbl in self.tables:
+        self.py_rect_speed.append(getattr(tbl, "speed", None))
+        self.orig_speeds.append(getattr(tbl, "speed", None))
+        self.coords.append([tbl.loc[0], tbl.loc[1]])
+        self.img_names.append(tbl.name)
+        self.profiles.append(speedProfile(tbl))
           
     # Calculate pixel motions:
     self.time_between_frames = 1/fps*self.simulation_speed 
@@ -444,6 +979,12 @@ class simulationVideo:
     self.pixel_distance = self.race_distance / (self.end_line - self.target_width)
     # print("number_of_frames=", num_of_frames)
 
+    # Characters with a speed profile use their average speed.
+    for py_idx, profile in enumerate(self.profiles):
+      if profile is not None:
+        self.orig_speeds[py_idx] = profileAverageSpeed(profile, self.race_distance)
+        self.py_rect_speed[py_idx] = self.orig_speeds[py_idx]
+
     # Rescale py_rect_speed:
     # x m/s -> y pixels/frame
     # y * fps * pixel_distance  is distance in one second
@@ -498,9 +1039,8 @@ class simulationVideo:
       print(f"The file '{self.video_name}' will be created.")
       
     # Open up the video file:
-    self.out_vid = cv2.VideoWriter(self.video_name, 
-                    cv2.VideoWriter_fourcc(*'MJPG'), 
-                    self.fps, (self.vid_width, self.vid_height))
+    self.out_vid = openVideoWriter(self.video_name, self.fps, 
+                                   (self.vid_width, self.vid_height), self.codec)
     
     # Check if VideoWriter was successfully initialized
     if not self.out_vid.isOpened():
@@ -509,152 +1049,846 @@ class simulationVideo:
       print("VideoWriter initialized successfully.")
       
       
-  def create_video(self):
-    """ Creates the video simulation stores it in a video file. """
-    self.open_video()
-    
-    # Set pygame display with video dimensions
-    vid_disp = pygame.display.set_mode((self.vid_width, self.vid_height))
-    
-    # Simulation loop:
-    current_duration = 0.0 
-    race_clock = 0.0 
-    frame_num = 0.0
+  def draw_lines(self, surface):
+    """ Draws the start line, stop line and bottom line. """
+    pygame.draw.line(surface, self.end_line_color, 
+                     (self.target_width, 0), (self.target_width, self.vid_height)) # start line
+    pygame.draw.line(surface, self.end_line_color, 
+                     self.end_line_start, self.end_line_end, 1)  
+    pygame.draw.line(surface, self.black, 
+                     (0, self.axis_line), 
+                     (self.end_line, self.axis_line), 1)  
+
+
+  def build_background(self, vid_disp):
+    """ Draws the static layer of the race: white fill, title, character names,
+        speed labels and lines. It is built once per video.
+    """
+    # Use the same pixel format as the display for fast copies.
+    background = pygame.Surface(vid_disp.get_size(), 0, vid_disp)
+    background.fill((255, 255, 255))
 
-    # Set the offset off the end line:
     offset = 20
+    text_x = self.end_line + offset
+    for py_idx, py_rect in enumerate(self.py_rects):
+      if self.lanes:
+        # The condensed panel only has the name.
+        self.readout_cache.blit_label(background, f"{self.img_names[py_idx]}", (text_x, py_rect.y))
+        continue
+
+      # Overlay image name and speed
+      self.text_cache.blit_label(background, f"{self.img_names[py_idx]}", (text_x, py_rect.y))
+      if self.profiles[py_idx] is None:
+        speed_label = f"Speed: {self.orig_speeds[py_idx]} {self.speed_string}"
+      else:
+        speed_label = f"Speed: ~{self.orig_speeds[py_idx]:.2f} {self.speed_string}"
+      self.text_cache.blit_label(background, speed_label, (text_x, py_rect.y + 60))
+
+    # Overlay video title
+    self.text_cache.blit_label(background, f"{self.vid_title}", (text_x, 10))
+
+    self.draw_lines(background)
+    return background
+
+
+  def race_clock(self, frame_num):
+    """ returns the simulated time shown at frame frame_num (a number or an array). """
+    current_duration = np.asarray(frame_num, dtype=float) / self.fps
+    return current_duration * self.simulation_speed
+
+
+  def finish_times(self):
+    """ returns when each character reaches the race distance (math.inf if never). """
+    finish_times = np.full(len(self.orig_speeds), math.inf)
+    for py_idx, (speed, profile) in enumerate(zip(self.orig_speeds, self.profiles)):
+      if profile is not None:
+        finish_times[py_idx] = profileFinishTime(profile, self.race_distance)
+      elif speed > 0:
+        finish_times[py_idx] = self.race_distance / speed
+    return finish_times
+
+
+  def race_distances(self, clocks):
+    """ returns the distance of each character (one row per character) at the 
+        race clocks. clocks has one row per character or is shared by all.
+    """
+    clocks = np.asarray(clocks, dtype=float)
+    shape  = np.broadcast_shapes((len(self.orig_speeds), 1), clocks.shape)
+    clocks = np.broadcast_to(clocks, shape)
+    distances = np.empty(shape)
+    for py_idx, (speed, profile) in enumerate(zip(self.orig_speeds, self.profiles)):
+      if profile is None:
+        distances[py_idx] = clocks[py_idx] * speed
+      else:
+        distances[py_idx] = profileDistances(profile, clocks[py_idx])
+    return distances
 
-    # Update pygame display for each table
-    stop = np.full(len(self.py_rects), False) 
-    stop_distances = np.full(len(self.py_rects), 0.0)
-    stop_times     = np.full(len(self.py_rects), 0.0)
+
+  def stop_frames(self):
+    """ returns, for each character, the first frame where it has reached the
+        race distance. It is math.inf if the character never gets there.
+    """
+    finish_times = self.finish_times()
+    stops  = np.full(len(finish_times), math.inf)
+    finite = np.isfinite(finish_times)
+    if not finite.any():
+      return stops
+
+    def reached(frame_nums):
+      clocks = self.race_clock(frame_nums)[:, np.newaxis]
+      return self.race_distances(clocks)[:, 0] >= self.race_distance
+
+    # Closed form, then fix the frames that are off by floating point rounding.
+    frame_nums = np.ceil(np.where(finite, finish_times, 0) * self.fps / self.simulation_speed)
     while True:
-      # Fill display with white color
-      vid_disp.fill((255, 255, 255))
-      
-      for py_idx, py_rect in enumerate(self.py_rects):
-        # Zero image speed once we reach reach the stop line
-        # Set up the stop_distance and stop_time if we reached the end for the first time
-        if ((not stop[py_idx]) and (race_clock*self.orig_speeds[py_idx] >= self.race_distance)):
-          stop[py_idx] = True 
-          stop_times[py_idx]     = race_clock
-          stop_distances[py_idx] = race_clock*self.orig_speeds[py_idx]
+      early = finite & (frame_nums > 0) & reached(frame_nums - 1)
+      if not early.any():
+        break
+      frame_nums -= early
+    while True:
+      late = finite & ~reached(frame_nums)
+      if not late.any():
+        break
+      frame_nums += late
+    stops[finite] = frame_nums[finite]
+    return stops
 
-        # Place the character image
-        vid_disp.blit(self.py_imgs[py_idx], py_rect)
-        
-        # Move the character
-        if (not stop[py_idx]): 
-          x, y = self.coords[py_idx]
-          dx   = self.py_rect_speed[py_idx]*frame_num
-          
-          py_img  = self.py_imgs[py_idx]
-          self.py_rects[py_idx] = pygame.Rect(round(x+dx), int(y), 
-                                    py_img.get_width(), py_img.get_height())
-            
-        # Overlay image name on video display
-        img_name = self.vid_disp_font.render(f"{self.img_names[py_idx]}", True, (0, 0, 0))
-        img_name_rect = img_name.get_rect()
-        img_name_rect.topleft = (self.end_line + offset, py_rect.y)
-        vid_disp.blit(img_name, img_name_rect)
-        
-        # Overlay image distance on video display
-        # distance = (py_rect.right - self.target_width)*self.pixel_distance
-        if (stop[py_idx]):
-          distance = stop_distances[py_idx]
-        else:
-          distance = race_clock * self.orig_speeds[py_idx]
 
-        dist = self.vid_disp_font.render(f"Distance: {distance:.2f} {self.distance_string}", 
-                                         True, (0, 0, 0))
-        dist_rect = dist.get_rect()
-        dist_rect.topleft = (self.end_line + offset, py_rect.y + 20)
-        vid_disp.blit(dist, dist_rect)
-        
-        # Overlay time on video display
-        # the_time = distance/self.orig_speeds[py_idx]
-        if (stop[py_idx]):
-          the_time = stop_times[py_idx]
-        else:
-          the_time = race_clock
+  def count_frames(self):
+    """ returns the number of simulated frames and the number of frames that
+        repeat the last one until the end of the duration.
+    """
+    last_stop = self.stop_frames().max()
+
+    # Terminate based on duration or all reached the end.
+    num_frames = math.floor(self.duration * self.fps) + 1
+    while (num_frames > 1) and ((num_frames - 1) / self.fps > self.duration):
+      num_frames -= 1
+    while num_frames / self.fps <= self.duration:
+      num_frames += 1
+    num_frames = min(num_frames, last_stop + 1)
+
+    if (num_frames > self.max_frames):
+      print("Too many frames!")
+      print("frame_num = ", self.max_frames + 1)
+      num_frames = int(self.max_frames) + 1
+
+    # Fill up with the same frame.
+    current_duration = num_frames / self.fps
+    frames_left = max(int((self.duration - current_duration)*self.fps), 0)
+    return int(num_frames), frames_left
+
+
+  def simulate(self, first_frame=0, last_frame=None):
+    """ returns the race state for frames first_frame, ..., last_frame-1 
+        (default: all the simulated frames) as NumPy arrays:
+          frames:   the frame numbers.
+          clock:    the race clock of each frame.
+          x, y:     the image position of each character (x has one row per character).
+          distance: the displayed distance of each character at each frame.
+          time:     the displayed time of each character at each frame.
+          finished: True once the character has reached the race distance.
+    """
+    if last_frame is None:
+      last_frame, _ = self.count_frames()
+    frames = np.arange(first_frame, last_frame)
+    clock  = self.race_clock(frames)
+
+    # Characters stop once they reach the stop line
+    stops    = self.stop_frames()[:, np.newaxis]
+    finished = frames >= stops
+    stop_clock = self.race_clock(np.where(np.isfinite(stops), stops, 0))
+    time     = np.where(finished, stop_clock, clock)
+    distance = self.race_distances(time)
+
+    # The image shown at a frame was moved in the previous frame.
+    coords = np.array(self.coords, dtype=float).reshape(-1, 2)
+    x0 = coords[:, :1]
+    moved_frames = np.minimum(frames, stops) - 1
+    speeds = np.array(self.py_rect_speed, dtype=float)[:, np.newaxis]
+    x = np.where(moved_frames > 0, np.round(x0 + speeds*moved_frames), x0)
+
+    # Characters with a speed profile are placed by their distance instead.
+    profiled = np.array([profile is not None for profile in self.profiles], dtype=bool)
+    if profiled.any():
+      travelled = self.race_distances(self.race_clock(np.maximum(moved_frames, 0)))
+      x = np.where(profiled[:, np.newaxis], np.round(x0 + travelled / self.pixel_distance), x)
+
+    # In lanes, finished characters are shown on the stop line.
+    if self.lanes:
+      x = np.where(finished, np.round(x0 + self.end_line - self.target_width), x)
+    x = x.astype(int)
+    y = coords[:, 1].astype(int)
+
+    return types.SimpleNamespace(frames=frames, clock=clock, x=x, y=y, 
+                                 distance=distance, time=time, finished=finished)
+
+
+  def export_trajectory(self, export_name, chunk_frames=4096):
+    """ writes the state of every simulated frame (see simulate()) to the 
+        directory export_name with one .npy file per column:
+          frames.npy, clock.npy:  one value per frame.
+          x.npy, distance.npy, time.npy, finished.npy: one row per character.
+          names.npy, y.npy:       one value per character.
+        The frames are simulated and written chunk_frames at a time, so long
+        races are not held in memory. Use loadTrajectory() to read it back.
+    """
+    num_frames, _ = self.count_frames()
+    num_chars = len(self.orig_speeds)
+    os.makedirs(export_name, exist_ok=True)
+
+    np.save(os.path.join(export_name, "names.npy"), np.array(self.img_names, dtype=str))
+    columns = dict(frames=((num_frames,), int), clock=((num_frames,), float),
+                   x=((num_chars, num_frames), int), distance=((num_chars, num_frames), float),
+                   time=((num_chars, num_frames), float), finished=((num_chars, num_frames), bool))
+    arrays = {name: np.lib.format.open_memmap(os.path.join(export_name, f"{name}.npy"), mode="w+",
+                                              dtype=dtype, shape=shape)
+              for name, (shape, dtype) in columns.items()}
+
+    for first_frame in range(0, num_frames, chunk_frames):
+      last_frame = min(first_frame + chunk_frames, num_frames)
+      state = self.simulate(first_frame, last_frame)
+      for name, array in arrays.items():
+        array[..., first_frame:last_frame] = getattr(state, name)
+    np.save(os.path.join(export_name, "y.npy"), state.y)
+
+    for array in arrays.values():
+      array.flush()
+    print("trajectory = ", export_name," saved.")
+
+
+  def results(self, times=None):
+    """ returns the race outcome as a pandas DataFrame with one row per character:
+          name:        character name.
+          speed:       the physical speed (the average speed for speed profiles).
+          finish_time: when the character reaches race_distance (inf if never).
+                       It is exact and not rounded to video frames.
+          place:       finish order. Ties share a place. NaN if it never finishes.
+        and one column of distances for each time in times.
+        Default times: 11 equal steps from 0 to duration.
+        No video is rendered, so this also works with render=False.
+    """
+    if times is None:
+      times = np.linspace(0, self.duration, 11)
+    times = np.asarray(times, dtype=float)
+    finish_times = self.finish_times()
 
-        dist = self.vid_disp_font.render(f"Time: {the_time:.2f} {self.time_string}", True, (0, 0, 0))
-        dist_rect = dist.get_rect()
-        dist_rect.topleft = (self.end_line + offset, py_rect.y + 40)
-        vid_disp.blit(dist, dist_rect)
-        
-        # Overlay image speed on video display 
-        spd = self.vid_disp_font.render(f"Speed: {self.orig_speeds[py_idx]} {self.speed_string}", True, (0, 0, 0))
-        spd_rect = spd.get_rect()
-        spd_rect.topleft = (self.end_line + offset, py_rect.y + 60)
-        vid_disp.blit(spd, spd_rect)
-        
-        # Update rectangle at image speed
-        # py_rect.move_ip([py_rect_speed[py_idx], 0])
+    # Characters stop at the finish, like the clocks shown in the video.
+    distances = self.race_distances(np.minimum(times, finish_times[:, np.newaxis]))
+
+    # Place = 1 + the number of characters that finish earlier.
+    places = np.searchsorted(np.sort(finish_times), finish_times, side="left") + 1.0
+    places[~np.isfinite(finish_times)] = np.nan
+
+    columns = {"name": self.img_names, "speed": self.orig_speeds,
+               "finish_time": finish_times, "place": places}
+    for idx, the_time in enumerate(times.tolist()):
+      columns[the_time] = distances[:, idx]
+    return pd.DataFrame(columns)
+
+
+  def condensed_columns(self, font):
+    """ returns the offsets of the distance and time columns of the condensed
+        panel and the width of its longest line for font.
+    """
+    gap = 8
+    distance_x = max([font.size(tbl.name)[0] for tbl in self.tables] + [0]) + gap
+    time_x = distance_x + font.size(f"{self.race_distance:.2f} {self.distance_string}")[0] + gap
+    return distance_x, time_x, time_x + font.size(f"{self.duration:.2f} {self.time_string}")[0]
+
+
+  def condensed_text_cache(self):
+    """ returns the text cache for the condensed panel: the largest font 
+        up to disp_font_sz that fits in a lane and in the panel width.
+    """
+    panel_width = self.vid_width - (self.end_line + 20)
+    font_size = max(8, min(self.disp_font_sz, int(self.lane_height)))
+    while font_size > 8 and self.condensed_columns(raceTextCache(font_size, self.black).font)[2] > panel_width:
+      font_size -= 1
+    return raceTextCache(font_size, self.black)
+
+
+  def readout_layout(self):
+    """ returns the (prefix, suffix, topleft) of the distance and time readouts of 
+        each character, and the position of the race clock.
+    """
+    offset = 20
+    text_x = self.end_line + offset
+    distance_slots = []
+    time_slots     = []
+    if self.lanes:
+      # One line per lane: name, distance and time in columns.
+      distance_x, time_x, _ = self.condensed_columns(self.readout_cache.font)
+      distance_x += text_x
+      time_x += text_x
+      for py_rect in self.py_rects:
+        distance_slots.append(("", f" {self.distance_string}", (distance_x, py_rect.y)))
+        time_slots.append(("", f" {self.time_string}", (time_x, py_rect.y)))
+      clock_pos = (text_x, self.axis_line + 10)
+    else:
+      for py_rect in self.py_rects:
+        distance_slots.append(("Distance: ", f" {self.distance_string}", (text_x, py_rect.y + 20)))
+        time_slots.append(("Time: ", f" {self.time_string}", (text_x, py_rect.y + 40)))
+      clock_pos = (text_x, self.py_rects[-1].y + 100)
+    return distance_slots, time_slots, clock_pos
+
+
+  def lines_cross(self, rect):
+    """ returns True if the start, stop or bottom line may pass through rect. """
+    return (rect.left - 1 <= self.target_width <= rect.right or 
+            rect.left - 1 <= self.end_line <= rect.right or
+            rect.top - 1 <= self.axis_line <= rect.bottom)
+
+
+  def render_frames(self, vid_disp, out_vid, first_frame, last_frame):
+    """ renders frames first_frame, ..., last_frame-1 on vid_disp and writes
+        them to out_vid. Returns the last frame written.
+    """
+    distance_slots, time_slots, clock_pos = self.readout_layout()
+
+    # Draw everything that does not move once, then copy the whole layer in.
+    background = self.build_background(vid_disp)
+    vid_disp.blit(background, (0, 0))
+    dirty_rects = []
+
+    # The whole race is computed up front. The loop only draws it.
+    state = self.simulate(first_frame, last_frame)
+    y_values = state.y.tolist()
+
+    cv2_img = None
+    for column, race_clock in enumerate(state.clock.tolist()):
+      positions = zip(state.x[:, column].tolist(), y_values)
+      distances = state.distance[:, column].tolist()
+      times     = state.time[:, column].tolist()
+
+      # Restore the regions drawn in the previous frame
+      vid_disp.blits([(background, rect, rect) for rect in dirty_rects], doreturn=False)
+      dirty_rects  = []
+      sprite_rects = []
+
+      # Collect the character images and readouts, then draw them in one call.
+      blit_list = []
+      for py_idx, (py_img, position) in enumerate(zip(self.py_imgs, positions)):
+        # Place the character image
+        sprite_rect = py_img.get_rect(topleft=position)
+        blit_list.append((py_img, sprite_rect))
+        sprite_rects.append(sprite_rect)
+        dirty_rects.append(sprite_rect)
+
+        # Overlay image distance and time on video display
+        for (prefix, suffix, topleft), value in ((distance_slots[py_idx], distances[py_idx]),
+                                                 (time_slots[py_idx], times[py_idx])):
+          glyphs, rect = self.readout_cache.readout_blits(prefix, value, suffix, topleft)
+          blit_list.extend(glyphs)
+          dirty_rects.append(rect)
         
       # Overlay clock time on video display
-      race_timer = self.vid_disp_font.render(f"Time: {race_clock:.2f} {self.time_string}", True, (0, 0, 0))
-      race_timer_rect = race_timer.get_rect()
-      race_timer_rect.topleft = (self.end_line + offset, self.py_rects[-1].y + 100)
-      vid_disp.blit(race_timer, race_timer_rect)
-      
-      # Overlay video title
-      vid_title_ = self.vid_disp_font.render(f"{self.vid_title}", True, (0, 0, 0))
-      vid_title_rect = vid_title_.get_rect()
-      vid_title_rect.topleft = (self.end_line + offset, 10)
-      vid_disp.blit(vid_title_, vid_title_rect)
-      
-      # Draw start line, stop line and bottom line
-      pygame.draw.line(vid_disp, self.end_line_color, 
-                       (self.target_width, 0), (self.target_width, self.vid_height)) # start line
-      pygame.draw.line(vid_disp, self.end_line_color, 
-                     self.end_line_start, self.end_line_end, 1)  
-      pygame.draw.line(vid_disp, self.black, 
-                     (0, self.axis_line), 
-                     (self.end_line, self.axis_line), 1)  
-      
-      # Update entire pygame display
-      pygame.display.flip()
-      
-      # Save pygame display as video 
-      cv2_img = pygame.surfarray.array3d(vid_disp)
-      cv2_img = cv2_img.transpose([1, 0, 2])
-      cv2_img = cv2.cvtColor(cv2_img, cv2.COLOR_RGB2BGR)
-      self.out_vid.write(cv2_img)
-
-      frame_num += 1.0
-      current_duration = frame_num / self.fps  
-      race_clock = current_duration  * self.simulation_speed
+      glyphs, rect = self.text_cache.readout_blits("Time: ", race_clock, f" {self.time_string}", clock_pos)
+      blit_list.extend(glyphs)
+      dirty_rects.append(rect)
+      vid_disp.blits(blit_list, doreturn=False)
       
+      # Redraw the lines where the characters were placed over them
+      for rect in sprite_rects:
+        if self.lines_cross(rect):
+          vid_disp.set_clip(rect)
+          self.draw_lines(vid_disp)
+      vid_disp.set_clip(None)
       
-      # Terminate based on duration or all reached the end.
-      stop_cond = current_duration > self.duration 
-      stop_cond = stop_cond or all(stop) 
+      if self.headless:
+        # The frame buffer already holds the BGR frame.
+        cv2_img = self.frame_buffer
+      else:
+        # Update entire pygame display
+        pygame.display.flip()
       
-      if (frame_num > self.max_frames):
-        print("Too many frames!")
-        print("frame_num = ", frame_num)
-        stop_cond = True 
-        
-      # Wait and break after reaching stop line        
-      if stop_cond:
-        # Fill up with the same frame.
-        frames_left = int((self.duration - current_duration)*self.fps)
-        if (frames_left > 0):
-            for i in range(frames_left):
-              self.out_vid.write(cv2_img)
+        # Save pygame display as video 
+        cv2_img = pygame.surfarray.array3d(vid_disp)
+        cv2_img = cv2_img.transpose([1, 0, 2])
+        cv2_img = cv2.cvtColor(cv2_img, cv2.COLOR_RGB2BGR)
+      out_vid.write(cv2_img)
+
+    return cv2_img
+
+
+  def load_text_caches(self):
+    """ gets the text caches for the video fonts. """
+    self.text_cache = raceTextCache(self.disp_font_sz, self.black)
+    self.vid_disp_font = self.text_cache.font
+    # The condensed panel uses one line of text per lane.
+    if self.lanes:
+      self.readout_cache = self.condensed_text_cache()
+    else:
+      self.readout_cache = self.text_cache
+
+
+  def create_display(self):
+    """ returns the pygame surface that frames are drawn on. """
+    # A video created before has closed pygame and its fonts.
+    if not pygame.get_init():
+      pygame.init()
+    self.load_text_caches()
+    if self.headless:
+      # Draw directly into a BGR frame in the layout the encoder expects.
+      self.frame_buffer = np.zeros((self.vid_height, self.vid_width, 3), dtype=np.uint8)
+      return pygame.image.frombuffer(self.frame_buffer, (self.vid_width, self.vid_height), "BGR")
+    else:
+      return pygame.display.set_mode((self.vid_width, self.vid_height))
+
+
+  def race_config(self):
+    """ returns the simulation parameters as plain data for worker processes. """
+    characters = [dict(name=tbl.name, img=tbl.img, loc=tuple(tbl.loc), 
+                       speed=getattr(tbl, "speed", None),
+                       data_values=getattr(tbl, "data_values", None)) 
+                  for tbl in self.tables]
+    units = dict(distance_string=self.distance_string, time_string=self.time_string,
+                 speed_string=self.speed_string)
+    video = dict(video_name=self.video_name, fps=self.fps, 
+                 vid_width=self.vid_width, vid_height=self.vid_height,
+                 max_frames=self.max_frames, target_width=self.target_width, 
+                 simulation_speed=self.simulation_speed, headless=True, codec=self.codec,
+                 lanes=self.lanes)
+    return dict(tables=characters, duration=self.duration, race_distance=self.race_distance,
+                vid_title=self.vid_title, units=units, video=video)
+
+
+  def write_frames(self, video_name, first_frame, last_frame, hold=0):
+    """ renders frames first_frame, ..., last_frame-1 into video_name 
+        and repeats the last frame hold more times.
+    """
+    out_vid = openVideoWriter(video_name, self.fps, (self.vid_width, self.vid_height), self.codec)
+    if not out_vid.isOpened():
+      raise RuntimeError("Error: Failed to initialize video writer.")
+
+    cv2_img = self.render_frames(self.create_display(), out_vid, first_frame, last_frame)
+    holdFrame(out_vid, cv2_img, hold)
+    out_vid.release()
+
+
+  def set_outputs(self, outputs=None):
+    """ Setup several videos to create from one simulation. 
+        outputs is a list of dictionaries with:
+          video_name: the file to prepare (required).
+          time_scale: multiplies simulation_speed. Default=1.0.
+                      All outputs show frames of one race rendered at the
+                      smallest time scale. Faster outputs differ a little from
+                      a separate run at their speed: the finish times shown use
+                      the finer time step of that race, and the images lag
+                      by one of its frames instead of one output frame.
+          resolution: (width, height) of the video. Default=(vid_width, vid_height).
+                      Frames are scaled from the rendered size (see fitFrame).
+          codec:      None for MJPG or an ffmpeg codec. Default=the codec of set_video().
+        create_video() then writes all of them instead of video_name.
+        set_outputs() with no outputs goes back to a single video.
+    """
+    self.outputs = []
+    for output in (outputs or []):
+      video_name = output.get("video_name")
+      if not isinstance(video_name, str):
+        raise ValueError('Each output needs a video_name string')
+
+      time_scale = output.get("time_scale", 1.0)
+      if not isinstance(time_scale, numbers.Number) or time_scale <= 0:
+        raise ValueError('Output time_scale should be a postive number')
+
+      resolution = tuple(output.get("resolution", (self.vid_width, self.vid_height)))
+      if len(resolution) != 2 or min(resolution) <= 0:
+        raise ValueError('Output resolution should be (width, height) with postive numbers')
+
+      self.outputs.append(dict(video_name=video_name, time_scale=time_scale,
+                               resolution=(int(resolution[0]), int(resolution[1])),
+                               codec=output.get("codec", self.codec)))
+
+    video_names = [output["video_name"] for output in self.outputs]
+    if len(set(video_names)) != len(video_names):
+      raise ValueError('Each output should have a different video_name')
+
+
+  def set_ladder(self, resolutions, codec=None):
+    """ Setup a resolution ladder: video_name at (vid_width, vid_height) and 
+        one more video for each (width, height) in resolutions, named like
+        race_240p.mp4. The race is rendered once at the full resolution and
+        scaled in the encoder, so every size has the same layout.
+        codec: the codec of every video. Default=the codec of set_video().
+    """
+    stem, ext = os.path.splitext(self.video_name)
+    codec = self.codec if codec is None else codec
+    outputs = [dict(video_name=self.video_name, codec=codec)]
+    for width, height in resolutions:
+      outputs.append(dict(video_name=f"{stem}_{height}p{ext}", resolution=(width, height), codec=codec))
+    self.set_outputs(outputs)
+
+
+  def scaled(self, time_scale):
+    """ returns a copy of the simulation running time_scale times faster. """
+    race = copy.copy(self)
+    race.simulation_speed = self.simulation_speed * time_scale
+    race.time_between_frames = self.time_between_frames * time_scale
+    race.num_of_frames = self.num_of_frames / time_scale
+    race.py_rect_speed = [speed * time_scale for speed in self.py_rect_speed]
+    return race
+
+
+  def create_outputs(self):
+    """ Helper function that renders the race once and writes every video of set_outputs().
+        The race is rendered at the smallest time scale. Faster outputs take 
+        every n-th frame and other resolutions are resized from the same frames.
+    """
+    base_scale = min(output["time_scale"] for output in self.outputs)
+    master = self.scaled(base_scale)
+
+    sinks = []
+    for output in self.outputs:
+      # The frames of this output and the rendered frames that they show.
+      num_frames, frames_left = self.scaled(output["time_scale"]).count_frames()
+      step = output["time_scale"] / base_scale
+      frame_map = [int(frame_num*step + 1e-9) for frame_num in range(num_frames)]
+
+      if os.path.exists(output["video_name"]):
+        os.remove(output["video_name"])
+      # Other resolutions are scaled from the rendered frames by the writer.
+      writer = openVideoWriter(output["video_name"], self.fps, output["resolution"], output["codec"],
+                               input_size=(self.vid_width, self.vid_height))
+      if not writer.isOpened():
+        raise RuntimeError("Error: Failed to initialize video writer.")
+      sinks.append(dict(writer=writer, frame_map=frame_map, frames_left=frames_left))
+
+    fan_out = fanOutWriter(sinks)
+    last_frame = max(sink["frame_map"][-1] for sink in sinks) + 1
+    master.render_frames(master.create_display(), fan_out, 0, last_frame)
+    fan_out.release()
+    quitPygame()
+
+    for output in self.outputs:
+      print("video file = ", output["video_name"]," closed.")
+    return [moviepy_editor.VideoFileClip(output["video_name"]) for output in self.outputs]
+
+
+  def create_video(self, processes=1, export=None):
+    """ Creates the video simulation stores it in a video file. 
+        processes > 1 renders segments of the video in parallel processes
+        and joins them without re-encoding.
+        If set_outputs() was used, all the outputs are created from one 
+        simulation and a list of videos is returned.
+        export: a directory to also save the simulated frames to 
+                (see export_trajectory). Default=None.
+    """
+    if not self.render:
+      raise ValueError('create_video() needs render=True. Use results() instead')
+
+    if export is not None:
+      self.export_trajectory(export)
+
+    if self.outputs:
+      if processes > 1:
+        raise ValueError('Parallel rendering does not support several outputs')
+      return self.create_outputs()
+
+    num_frames, frames_left = self.count_frames()
+
+    if processes > 1:
+      self.create_video_parallel(num_frames, frames_left, processes)
+    else:
+      self.open_video()
+      vid_disp = self.create_display()
+      cv2_img = self.render_frames(vid_disp, self.out_vid, 0, num_frames)
+
+      # Fill up with the same frame.
+      holdFrame(self.out_vid, cv2_img, frames_left)
               
-        self.out_vid.release()
-        pygame.quit()
-        print("video file = ", self.video_name," closed.")
-        break 
+      self.out_vid.release()
+      quitPygame()
+      print("video file = ", self.video_name," closed.")
       
-    race_video = moviepy.editor.VideoFileClip(self.video_name)
+    race_video = moviepy_editor.VideoFileClip(self.video_name)
     return(race_video)
 
 
+  def create_video_parallel(self, num_frames, frames_left, processes):
+    """ Helper function that renders the frames in chunks on a process pool
+        and joins the chunks in order.
+    """
+    # Video to store pygame
+    if os.path.exists(self.video_name):
+      # Remove the file
+      os.remove(self.video_name)
+      print(f"File '{self.video_name}' has been removed.")
+    else:
+      print(f"The file '{self.video_name}' will be created.")
+
+    # Split the frames into contiguous chunks
+    processes = min(processes, num_frames)
+    bounds = np.linspace(0, num_frames, processes + 1).astype(int)
+    config = self.race_config()
+    
+    segment_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(self.video_name)))
+    try:
+      segment_names = []
+      with ProcessPoolExecutor(max_workers=processes, 
+                               mp_context=multiprocessing.get_context("spawn")) as pool:
+        jobs = []
+        for chunk in range(processes):
+          segment_name = os.path.join(segment_dir, f"segment{chunk:04d}.mp4")
+          segment_names.append(segment_name)
+          # The last segment keeps the final frame until the end of the duration.
+          hold = frames_left if chunk == processes - 1 else 0
+          jobs.append(pool.submit(renderSegment, config, bounds[chunk], bounds[chunk + 1], 
+                                  hold, segment_name))
+        for job in jobs:
+          job.result()
+
+      concatVideos(self.video_name, segment_names)
+    finally:
+      shutil.rmtree(segment_dir, ignore_errors=True)
+
+    print("video file = ", self.video_name," closed.")
+
+
+class fanOutWriter:
+  """
+  Sends the frames of one rendering to several video writers.
+  Writers for other resolutions scale the frames themselves (see openVideoWriter).
+  Each sink is a dictionary with:
+    writer:      the video writer.
+    frame_map:   the rendered frame shown by each frame of this video.
+    frames_left: how many times the last frame is repeated at the end.
+  """
+
+  def __init__(self, sinks):
+    self.sinks = sinks
+    self.frame_num = 0  # index of the next rendered frame
+    for sink in self.sinks:
+      sink["next"] = 0  # index of the next frame of this video
+
+  def write(self, frame):
+    for sink in self.sinks:
+      frame_map = sink["frame_map"]
+      count = 0
+      while sink["next"] < len(frame_map) and frame_map[sink["next"]] == self.frame_num:
+        count += 1
+        sink["next"] += 1
+      if count == 0:
+        continue
+
+      # The last frame also fills up the rest of the video.
+      if sink["next"] == len(frame_map):
+        count += sink["frames_left"]
+      holdFrame(sink["writer"], frame, count)
+    self.frame_num += 1
+
+  def release(self):
+    for sink in self.sinks:
+      sink["writer"].release()
+
+
+def raceFromConfig(config):
+  """ builds a simulationVideo from the plain data returned by race_config(). """
+  tables = [types.SimpleNamespace(**character) for character in config["tables"]]
+  race = simulationVideo(tables, config["duration"], config["race_distance"], config["vid_title"])
+  race.set_units(**config["units"])
+  race.set_video(**config["video"])
+  return race
+
+def renderSegment(config, first_frame, last_frame, hold, segment_name):
+  """ renders frames first_frame, ..., last_frame-1 of a race into segment_name
+      and repeats the last frame hold more times. Used by worker processes.
+  """
+  race = raceFromConfig(config)
+  race.write_frames(segment_name, int(first_frame), int(last_frame), hold)
+  return segment_name
+
+def renderRace(config):
+  """ renders a whole race from race_config() data in this process.
+      Returns the video name, the number of frames and the time it took.
+  """
+  start_time = time.perf_counter()
+  race = raceFromConfig(config)
+  num_frames, frames_left = race.count_frames()
+  race.write_frames(race.video_name, 0, num_frames, frames_left)
+  return dict(video_name=race.video_name, frames=num_frames + frames_left,
+              seconds=time.perf_counter() - start_time)
+
+def initRaceWorker(sprite_pack=None):
+  """ sets up a worker process for renderRaces(). pygame, the ffmpeg
+      executable, fonts and sprites are then shared by all jobs of the worker.
+  """
+  os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+  pygame.init()
+  ffmpegBinary()
+  if sprite_pack is not None:
+    sprite_cache.load_pack(sprite_pack)
+
+def renderRaces(races, processes=None, sprite_pack=None):
+  """ renders many races at once on a pool of worker processes.
+      races:     a list of simulationVideo objects or race_config() dictionaries.
+                 Each race needs its own video_name.
+      processes: the number of worker processes. Default=the number of CPUs.
+      sprite_pack: an optional file from sprite_cache.save_pack() with the
+                 sprites already scaled. Workers then skip image decoding.
+
+      Returns a list with one dictionary per race: video_name, frames, 
+      seconds (the render time) and error (None if the video was created).
+  """
+  configs = [race.race_config() if isinstance(race, simulationVideo) else race 
+             for race in races]
+  video_names = [config["video"]["video_name"] for config in configs]
+  if len(set(video_names)) != len(video_names):
+    raise ValueError('Each race should have a different video_name')
+
+  if processes is None:
+    processes = os.cpu_count() or 1
+  processes = max(1, min(processes, len(configs)))
+
+  results = []
+  start_time = time.perf_counter()
+  with ProcessPoolExecutor(max_workers=processes, initializer=initRaceWorker,
+                           initargs=(sprite_pack,), mp_context=multiprocessing.get_context("spawn")) as pool:
+    jobs = [pool.submit(renderRace, config) for config in configs]
+    for video_name, job in zip(video_names, jobs):
+      try:
+        result = job.result()
+        result["error"] = None
+      except Exception as err:
+        result = dict(video_name=video_name, frames=0, seconds=0.0, error=str(err))
+      results.append(result)
+
+      if result["error"] is None:
+        print(f"{video_name}: {result['frames']} frames in {result['seconds']:.2f} seconds")
+      else:
+        print(f"{video_name}: FAILED: {result['error']}")
+
+  print(f"Rendered {len(results)} races in {time.perf_counter() - start_time:.2f} seconds "
+        f"with {processes} processes.")
+  return results
 
-def CreateVideo(video_name, file_list, fps, durations):
+
+
+def loadTrajectory(export_name, mmap_mode="r"):
+  """ reads a trajectory saved by simulationVideo.export_trajectory().
+      The columns are memory-mapped by default, so only the parts used are read.
+      Returns the same fields as simulationVideo.simulate() plus names.
+  """
+  columns = {}
+  for name in ("frames", "clock", "x", "y", "distance", "time", "finished"):
+    columns[name] = np.load(os.path.join(export_name, f"{name}.npy"), mmap_mode=mmap_mode)
+  columns["names"] = np.load(os.path.join(export_name, "names.npy")).tolist()
+  return types.SimpleNamespace(**columns)
+
+
+def copyVideoFrames(cap, video, canvas, src_fps, fps):
+  """ pads the frames read from cap and writes them to video at fps frames per second.
+      Output frame k shows the source frame at time k/fps. Source frames that are 
+      not shown are skipped without decoding them (grab() without retrieve()).
+      Source frames shown more than once are decoded and padded once.
+  """
+  if not src_fps or src_fps <= 0:
+    # Unknown source rate: write every frame.
+    src_fps = fps
+  step = src_fps / fps
+
+  frame = None
+  src_idx = 0  # index of the next source frame
+  out_idx = 0  # index of the next output frame
+  while True:
+    # Read the next source frame. It is only decoded if it is shown.
+    if not cap.grab():
+      break
+    if int(out_idx*step + 1e-9) > src_idx:
+      src_idx += 1
+      continue
+
+    ret, frame = cap.retrieve(frame)
+    if not ret:
+      break
+
+    # Count the output frames that show this source frame.
+    count = 0
+    while int(out_idx*step + 1e-9) == src_idx:
+      count   += 1
+      out_idx += 1
+
+    # pad the frame and write to the file:
+    holdFrame(video, canvas.pad(frame), count)
+    src_idx += 1
+
+# FourCC codes produced by the ffmpeg codecs that openVideoWriter() accepts.
+# codec=None writes MJPG with OpenCV, which falls back to mp4v in .mp4 files.
+_codec_fourccs = {None:    ["MJPG", "mjpg", "jpeg", "mp4v"],
+                  "mjpeg": ["MJPG", "mjpg", "jpeg"],
+                  "libx264": ["avc1", "h264", "H264"],
+                  "libx265": ["hvc1", "hev1"]}
+
+def canConcatenate(infos, fps, codec=None):
+  """ returns True if the probed inputs are all videos with the same codec,
+      size and frame rate fps, so that they can be joined by copying packets.
+      The inputs must also be encoded the way openVideoWriter() encodes codec.
+  """
+  if len(infos) == 0 or any(info["kind"] != "video" for info in infos):
+    return False
+
+  first = infos[0]
+  for info in infos:
+    if (info["codec"], info["width"], info["height"]) != (first["codec"], first["width"], first["height"]):
+      return False
+    if abs(info["fps"] - fps) > 1e-3:
+      return False
+
+  if first["codec"] not in _codec_fourccs.get(codec, []):
+    return False
+  return True
+
+# probeMedia() results, keyed by (path, modification time, file size).
+_media_info = {}
+
+def probeMedia(filename):
+  """ returns the size of an image or the properties of an .mp4 video
+      from the file headers, without decoding any pixels.
+      Returns a dictionary with kind ("image" or "video"), width and height.
+      Videos also have fps, frame_count and codec (the FourCC string).
+      Results are cached until the file changes.
+  """
+  try:
+    stat = os.stat(filename)
+  except OSError:
+    raise ValueError("file name = "+filename+" cannot be opened!")
+
+  key = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+  if key not in _media_info:
+    if (filename.lower().endswith('.mp4')):
+      # Only the container and stream headers are read.
+      cap = cv2.VideoCapture(filename)
+      if not cap.isOpened():
+        raise ValueError("file name = "+filename+" cannot be opened!")
+
+      fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+      info = dict(kind="video",
+                  width=int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                  height=int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                  fps=cap.get(cv2.CAP_PROP_FPS),
+                  frame_count=int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+                  codec="".join(chr((fourcc >> 8*i) & 0xFF) for i in range(4)))
+      cap.release()
+    else:
+      # PIL reads the image size without decoding the image.
+      try:
+        with Image.open(filename) as img:
+          width, height = img.size
+          # cv2.imread() rotates images with an EXIF orientation tag.
+          if img.getexif().get(0x0112) in (5, 6, 7, 8):
+            width, height = height, width
+      except Exception:
+        raise ValueError("file name = "+filename+" cannot be opened!")
+      info = dict(kind="image", width=width, height=height)
+    _media_info[key] = info
+
+  return dict(_media_info[key])
+
+def CreateVideo(video_name, file_list, fps, durations, codec=None):
+  """ combines images and videos into video_name. Images are shown for their duration.
+      codec=None writes MJPG with OpenCV. An ffmpeg codec name (e.g. "libx264")
+      encodes the final video directly with ffmpeg.
+  """
   # Check array lengths:
   if (len(durations) != len(file_list)):
     print("The lists are of different lengths!")
@@ -667,41 +1901,29 @@ def CreateVideo(video_name, file_list, fps, durations):
   #self.plot_to_frame()
   height_list  = []
   width_list   = []
+  images = {}  # images that had to be decoded to find their size
+  infos  = {}  # probeMedia() results
 
   # Find the biggest sizes
   for filename in file_list:
-    # Check if we are working with a video file:
-    if (filename.lower().endswith('.mp4')):
-      # Open the file:
-      print("Opening ", filename)
-      cap = cv2.VideoCapture(filename)
-      
-      # Check if video opened successfully
-      if not cap.isOpened():
+    print("Opening ", filename)
+    try:
+      info = probeMedia(filename)
+    except ValueError:
+      if (filename.lower().endswith('.mp4')):
         print("Error: Could not open video: file name = ", filename)
-        raise ValueError("file name = "+filename+" cannot be opened!")
-      
-      # Get video properties
-      width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-      height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-      frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-
-      # Append them:
-      height_list.append(height)
-      width_list.append(width)
-
-      cap.release()
-    else:
-      print("Opening ", filename)
+        raise
+      # The header could not be read. Decode the image once and keep it.
       img = cv2.imread(filename)
-
       if img is None:
         print("Error: Could not open image: file name = ", filename)
         raise ValueError("file name = "+filename+" cannot be opened!")
+      images[filename] = img
+      info = dict(kind="image", height=img.shape[0], width=img.shape[1])
       
-      height, width, channels = img.shape
-      height_list.append(height)
-      width_list.append(width)
+    infos[filename] = info
+    height_list.append(info["height"])
+    width_list.append(info["width"])
 
   #print(height_list)
   h_video=np.max(height_list)
@@ -716,11 +1938,18 @@ def CreateVideo(video_name, file_list, fps, durations):
   else:
     print(f"The file '{video_name}' will be created.")
 
+  # Videos that already match each other and the frame rate are joined without re-encoding.
+  if canConcatenate([infos[filename] for filename in file_list], fps, codec):
+    try:
+      concatVideos(video_name, file_list)
+      print("Joined the videos without re-encoding.")
+      return moviepy_editor.VideoFileClip(video_name)
+    except RuntimeError as err:
+      print(err)
+      print("Re-encoding the videos instead.")
+
   #fourcc = cv2.VideoWriter_fourcc('X', 'V', 'I', 'D')
-  video = cv2.VideoWriter(video_name,
-            cv2.VideoWriter_fourcc(*'MJPG'),
-            fps,
-            (w_video, h_video))
+  video = openVideoWriter(video_name, fps, (int(w_video), int(h_video)), codec)
   
   # Check if VideoWriter was successfully initialized
   if not video.isOpened():
@@ -729,6 +1958,7 @@ def CreateVideo(video_name, file_list, fps, durations):
     print("VideoWriter initialized successfully.")
 
   # Save all of the frames after padding
+  canvas = paddingCanvas(h_video, w_video)
   for filename, duration in zip(file_list, durations):
     # Check if we are working with a video file:
     if (filename.lower().endswith('.mp4')):
@@ -740,23 +1970,17 @@ def CreateVideo(video_name, file_list, fps, durations):
         print("Error: Could not open video: file name = ", filename)
         return None
       
-      # Read all the frames:
-      while True:
-        # Read frame
-        ret, frame = cap.read()
-
-        # If frame is read correctly ret is True
-        if not ret:
-            break
-        
-        # pad the frame and write to the file:
-        video = padding(frame, video, h_video, w_video)
+      # Read all the frames at the output frame rate:
+      copyVideoFrames(cap, video, canvas, infos[filename]["fps"], fps)
 
       # When everything done, release the video capture object
       cap.release()
     else:
       # pad the frame and write to the file:
-      image = cv2.imread(filename)
+      if filename in images:
+        image = images[filename]
+      else:
+        image = cv2.imread(filename)
       if image is None:
         print("I cannot open filename = ", filename)
         break
@@ -770,17 +1994,19 @@ def CreateVideo(video_name, file_list, fps, durations):
       else:
         frame = image
 
+      # Pad the still image once and repeat it.
       num_of_frames = int(duration*fps) 
-      for i in range(num_of_frames):
-        video = padding(frame, video, h_video, w_video)
+      holdFrame(video, canvas.pad(frame), num_of_frames)
 
   # Close the video
   video.release()
-  final_video = moviepy.editor.VideoFileClip(video_name)
+  final_video = moviepy_editor.VideoFileClip(video_name)
   return(final_video)
   
-def padding(frame, video, h_video, w_video):
-  old_h, old_w, channels = frame.shape
+def paddingSizes(old_h, old_w, h_video, w_video):
+  """ returns the top, bottom, left and right padding that centers 
+      an old_h x old_w frame in an h_video x w_video frame.
+  """
   if divmod(h_video - old_h, 2)[1] != 0:
     pad_h_t = int((h_video - 1 - old_h) /2)
     pad_h_b = int((h_video + 1 - old_h) /2)
@@ -797,67 +2023,231 @@ def padding(frame, video, h_video, w_video):
     pad_w_l = int((w_video - old_w) /2)
     pad_w_r = int((w_video - old_w) /2)
 
-  padding_image = cv2.copyMakeBorder(frame,
-    pad_h_t, pad_h_b,
-    pad_w_l, pad_w_r,
-    cv2.BORDER_CONSTANT,
-    None,
-    value = [255, 255, 255])
+  return pad_h_t, pad_h_b, pad_w_l, pad_w_r
+
+class paddingCanvas:
+  """
+  A white h_video x w_video image that is reused to pad frames.
+  Each frame is copied into a centered region of the canvas, so padding
+  does not allocate a new image per frame. Frames that already have the
+  video size are returned as they are.
+  """
+
+  def __init__(self, h_video, w_video):
+    self.h_video = int(h_video)
+    self.w_video = int(w_video)
+    self.canvas  = np.full((self.h_video, self.w_video, 3), 255, dtype=np.uint8)
+    self.region  = None  # (top, left, height, width) of the last frame
+
+  def pad(self, frame):
+    """ returns frame centered on the canvas. The result is overwritten by the next call. """
+    old_h, old_w = frame.shape[:2]
+    if (old_h, old_w) == (self.h_video, self.w_video):
+      return frame
 
-  new_h, new_w, channels = padding_image.shape
+    pad_h_t, pad_h_b, pad_w_l, pad_w_r = paddingSizes(old_h, old_w, self.h_video, self.w_video)
+    region = (pad_h_t, pad_w_l, old_h, old_w)
+    if region != self.region:
+      # Clear what was left by a frame of a different size.
+      self.canvas.fill(255)
+      self.region = region
+
+    self.canvas[pad_h_t:pad_h_t + old_h, pad_w_l:pad_w_l + old_w] = frame[:, :, :3]
+    return self.canvas
+
+# One padding canvas per video size, used by padding().
+_padding_canvases = {}
+
+def padding(frame, video, h_video, w_video):
+  key = (int(h_video), int(w_video))
+  if key not in _padding_canvases:
+    _padding_canvases[key] = paddingCanvas(h_video, w_video)
+  padding_image = _padding_canvases[key].pad(frame)
   video.write(padding_image)
   return video
 
+# Compressed videos are cached here by content hash.
+video_cache_dir = "video_cache"
+
+# fileHash() results, keyed by (path, modification time, file size).
+_file_hashes = {}
+
+def fileHash(filename):
+  """ returns the SHA-256 hex digest of the contents of filename. """
+  stat = os.stat(filename)
+  key  = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+  if key not in _file_hashes:
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+      for chunk in iter(lambda: f.read(1024*1024), b""):
+        digest.update(chunk)
+    _file_hashes[key] = digest.hexdigest()
+  return _file_hashes[key]
+
+def runFFmpeg(args, duration=None, label="ffmpeg"):
+  """ runs ffmpeg with args and prints its progress every 10%.
+      duration is the length of the input in seconds (used for the percentage).
+      Raises RuntimeError with ffmpeg's messages if it fails.
+  """
+  cmd = [ffmpegBinary(), "-y", "-nostats", "-loglevel", "error", "-progress", "pipe:1"] + args
+  with tempfile.TemporaryFile() as stderr:
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr, text=True)
+    next_report = 10
+    for line in proc.stdout:
+      key, _, value = line.strip().partition("=")
+      if key == "out_time_us" and duration and value.isdigit():
+        percent = 100 * int(value) / 1e6 / duration
+        if percent >= next_report:
+          print(f"{label}: {min(percent, 100):.0f}%")
+          next_report = 10*(int(percent)//10 + 1)
+    returncode = proc.wait()
+
+    stderr.seek(0)
+    message = stderr.read().decode(errors="replace")
+
+  if returncode != 0:
+    raise RuntimeError(f"Error: ffmpeg exited with status {returncode}.\n" + message)
+
 # Original method for displaying video in Jupyter Notebook.
 class MakeVideo:
-  def __init__(self, mp4_fname, width, height):
+  # ffmpeg settings used to compress the video.
+  encoder_args = ["-vcodec", "libx264"]
+
+  # With embed="auto", larger videos are linked instead of stored in the notebook.
+  max_inline_bytes = 1024*1024
+
+  def __init__(self, mp4_fname, width, height, embed="inline"):
     """ compresses the video file and displays in Jupyter notebook.
         mp4_fname represents the filename of the mp4 video.
+        embed is "inline" (default), "auto" or "link" (see HTML_vid).
     """
     self.mp4_fname = mp4_fname
     self.width  = width
     self.height = height
+    self.embed  = embed
 
-    # Compress file
-    temp_file = "temp_video.mp4"
-    self.compress(temp_file)
+    # Compress file (or reuse a previous compression of the same video)
+    self.compressed_fname = self.compress()
 
     # Create HTML for video display
-    self.HTML_vid(temp_file)
+    self.HTML_vid(self.compressed_fname)
 
-  def compress(self, compressed_fname):
-    """ compresses the given video file to compressed_finame
-        If the filename is found, it replaces it with the current filename.
+  def cached_name(self):
+    """ returns the cache file for the compressed video. It depends on 
+        the contents of the video and on the encoder settings.
+    """
+    key = fileHash(self.mp4_fname) + " ".join(self.encoder_args)
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(self.mp4_fname))[0]
+    return os.path.join(video_cache_dir, f"{stem}-{digest}.mp4")
+
+  def compress(self, compressed_fname=None):
+    """ compresses the given video file to compressed_fname and returns its name.
+        By default, the result is cached in video_cache_dir and reused
+        as long as the video and the encoder settings do not change.
+        If compressed_fname is given, it is replaced with a new compression.
     """
-    # Remove the compressed file name:
-    if os.path.exists(compressed_fname):
-      os.remove(compressed_fname)
+    if compressed_fname is None:
+      compressed_fname = self.cached_name()
+      if os.path.exists(compressed_fname):
+        print("Using " + compressed_fname + " (already compressed)")
+        return compressed_fname
+
+    # Compress into a unique file and move it into place when done, so that
+    # compressions running at the same time do not clobber each other.
+    out_dir = os.path.dirname(os.path.abspath(compressed_fname))
+    os.makedirs(out_dir, exist_ok=True)
+    tmp_fd, tmp_fname = tempfile.mkstemp(suffix=".mp4", dir=out_dir)
+    os.close(tmp_fd)
+    try:
+      # The duration is only used to show the progress.
+      try:
+        info = probeMedia(self.mp4_fname)
+        duration = info["frame_count"] / info["fps"] if info.get("fps") else None
+      except ValueError:
+        # probeMedia() only reads .mp4 videos. ffmpeg reads the others.
+        duration = None
+      runFFmpeg(["-i", self.mp4_fname] + self.encoder_args + [tmp_fname],
+                duration, label="Compressing " + self.mp4_fname)
+      os.replace(tmp_fname, compressed_fname)
+    finally:
+      if os.path.exists(tmp_fname):
+        os.remove(tmp_fname)
 
-    # Use ffmpeg to compress
-    mp4_str = f"ffmpeg -i {self.mp4_fname} -vcodec libx264 {compressed_fname}"
-    os.system(mp4_str)
     print("Compressed "+ self.mp4_fname + " into " + compressed_fname)
+    return compressed_fname
 
-  def HTML_vid(self, compressed_fname):
+  def HTML_vid(self, compressed_fname, embed=None):
     """ displays the compressed file in Juyter notebook.
+        embed="inline" stores the video in the notebook as base64. It works everywhere.
+        embed="link" refers to the video file by its path relative to the notebook.
+        It keeps notebooks small, but it only plays where the notebook server 
+        serves local files (e.g. Jupyter). Colab cannot, and shows a blank video.
+        embed="auto" inlines videos up to max_inline_bytes and links larger ones,
+        except in Colab, where it always inlines.
     """
-    mp4 = open(compressed_fname,'rb').read()
-    data_url = "data:video/mp4;base64," + b64encode(mp4).decode()
+    if embed is None:
+      embed = self.embed
+    if embed not in ("auto", "inline", "link"):
+      raise ValueError('embed should be "auto", "inline" or "link"')
+
+    if embed == "auto":
+      small = os.path.getsize(compressed_fname) <= self.max_inline_bytes
+      embed = "inline" if small or "google.colab" in sys.modules else "link"
+
+    if embed == "inline":
+      # Encode in chunks whose size is a multiple of 3 bytes, so they join into one string.
+      chunks = []
+      with open(compressed_fname, 'rb') as mp4:
+        for chunk in iter(lambda: mp4.read(3*256*1024), b""):
+          chunks.append(b64encode(chunk).decode())
+      src = "data:video/mp4;base64," + "".join(chunks)
+    else:
+      src = os.path.relpath(compressed_fname).replace(os.sep, "/")
+
+    self.embed_mode = embed
     self.HTML_str = """
                  <video width="%s" height="%s" controls loop autoplay>
                     <source src="%s" type="video/mp4">
-                 </video> """ % (self.width, self.height, data_url)
+                 </video> """ % (self.width, self.height, src)
 
 # Function to change video speed.
 # Example usage: Double the speed
 # change_playback_speed("all.mp4", "all2.mp4", 0.5)
-def changeVideoSpeed(input_video, output_video, speed_factor):
-    """ changeVideoSpeed() can be used to create a video at a different speed. """
-    video = VideoFileClip(input_video)
+def changeVideoSpeed(input_video, output_video, speed_factor, fast=True):
+    """ changeVideoSpeed() can be used to create a video at a different speed. 
+        With fast=True, videos without sound are sped up or slowed down by
+        rescaling their timestamps: the frames are copied, not re-encoded,
+        and the frame rate becomes speed_factor times the original one
+        (up to the rounding of the time base of the video file).
+        Videos with sound, or fast=False, are re-encoded with moviepy.
+    """
+    if fast and not hasAudio(input_video):
+      time_scale = repr(1.0/speed_factor)
+      try:
+        # -itsscale does not rescale the packet durations, so the last frame 
+        # would keep its old length. The setts filter rescales them too.
+        runFFmpeg(["-itsscale", time_scale, "-i", input_video, "-map", "0:v", "-c", "copy",
+                   "-bsf:v", f"setts=pts=PTS:dts=DTS:duration=DURATION*{time_scale}",
+                   output_video])
+        print("Changed the speed of " + input_video + " into " + output_video)
+        return
+      except RuntimeError as err:
+        print(err)
+        print("Re-encoding the video instead.")
+
+    video = moviepy_editor.VideoFileClip(input_video)
     # Speed up or slow down the video
-    new_video = video.fx(vfx.speedx, speed_factor)
+    new_video = video.fx(moviepy_editor.vfx.speedx, speed_factor)
     new_video.write_videofile(output_video)
 
+def hasAudio(filename):
+  """ returns True if the video file has an audio stream. """
+  result = subprocess.run([ffmpegBinary(), "-hide_banner", "-i", filename], 
+                          capture_output=True, text=True)
+  return any(line.strip().startswith("Stream") and "Audio:" in line 
+             for line in result.stderr.splitlines())
+
 
 # Create and save an image with text.
 def textImage(output_path, multiline_string, image_size=(500, 300), font_scale=1, font_color=(0, 0, 0), line_space=0):